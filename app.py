@@ -1,9 +1,13 @@
-import copy
+import functools
 import io
 import logging
+import os
 import re
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from threading import Lock, Thread
 
 import dash
 import dash_core_components as dcc
@@ -11,10 +15,12 @@ import dash_html_components as html
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objs as go
+import redis
 import requests
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 from flask import send_file
 from flask_caching import Cache
+from requests.adapters import HTTPAdapter
 
 app = dash.Dash(__name__)
 app.index_string = """<!DOCTYPE html>
@@ -63,18 +69,18 @@ app.index_string = """<!DOCTYPE html>
 app.title = 'Larimer County COVID-19'
 server = app.server
 server.config.from_object("settings")
-logging.basicConfig(level='INFO')
+logging.basicConfig(level='INFO', format='%(asctime)s %(levelname)s:%(name)s:%(message)s')
 
 cache = Cache()
 cache.init_app(
     app.server,
     config={
-        "CACHE_DIR": server.config["CACHE_DIR"],
         "CACHE_TYPE": server.config["CACHE_TYPE"],
+        "CACHE_REDIS_URL": server.config["CACHE_REDIS_URL"],
         "CACHE_DEFAULT_TIMEOUT": server.config["CACHE_DEFAULT_TIMEOUT"],
+        "CACHE_KEY_PREFIX": server.config["CACHE_KEY_PREFIX"],
     }
 )
-cache.clear()
 
 MARKDOWN = '''
 #### 
@@ -124,6 +130,8 @@ app.layout = html.Div(
             html.Div(id='graph-container', className="u-max-full-width"),
         ]),
         html.Div(id='ticker-text', className="row ticker-text"),
+        # the ticker text currently shown, so unchanged ticks can be skipped
+        dcc.Store(id='ticker-shown'),
         dcc.Interval(id='interval', interval=server.config["UPDATE_INTERVAL"], n_intervals=0),
         dcc.Markdown(
             "Matthew Krump | [matthewkrump.com](https://matthewkrump.com/) | Rendered by [Dash](https://plotly.com/dash/)",
@@ -133,127 +141,287 @@ app.layout = html.Div(
 )
 
 
-@cache.cached()
+CASES_URL = "https://speedtest.larimer.org/covid/index.php"
+DEATHS_URL = "https://larimer-county-data-lake.s3-us-west-2.amazonaws.com/Public/covid/covid_deaths.csv"
+
+# the session this process made, see get_session
+local_session = {"pid": None, "session": None}
+
+
+def get_session():
+    # reuse connections across refreshes, one pool per host. made lazily
+    # per process, a session copied into a gunicorn worker from the
+    # preloaded master may hold the master's pool locks and sockets
+    if local_session["pid"] != os.getpid():
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=2))
+        local_session.update(pid=os.getpid(), session=session)
+    return local_session["session"]
+
+
+def fetch_csv(url, parse, params=None):
+    # conditional GET, if the file hasn't changed since the last fetch
+    # reuse the frame parsed from it instead of downloading and parsing again.
+    # returns the frame and whether it is new
+    key = f"fetch_csv/{url}"
+    cached = cache.get(key)
+    headers = cached["validators"] if cached is not None else {}
+    r = get_session().get(url, params=params, headers=headers, timeout=10)
+    if r.status_code == 304 and cached is not None:
+        return cached["df"], False
+    r.raise_for_status()
+    df = parse(r.content)
+    validators = {}
+    if "ETag" in r.headers:
+        validators["If-None-Match"] = r.headers["ETag"]
+    if "Last-Modified" in r.headers:
+        validators["If-Modified-Since"] = r.headers["Last-Modified"]
+    cache.set(key, {"validators": validators, "df": df}, timeout=0)
+    return df, True
+
+
 def update_metrics():
     ms = time.time_ns() // 1000000
-    # cases
-    r = requests.get(
-        f"https://speedtest.larimer.org/covid/index.php?t={ms}&gid=1219297132&csv=cases"
-    )
-    cases_df = create_cases_df(r.content)
-
-    # deaths
-    r = requests.get(
-        f"https://larimer-county-data-lake.s3-us-west-2.amazonaws.com/Public/covid/covid_deaths.csv?t={ms}"
-    )
-    deaths_df = create_deaths_df(r.content)
-    now = datetime.now().isoformat()
-    logging.info("update_metrics {0}".format(now))
-    return deaths_df, cases_df, datetime.now().isoformat()
+    # the files are on different hosts, so fetch them at the same time
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # cases
+        cases = executor.submit(
+            fetch_csv, CASES_URL, create_cases_df, params={"t": ms, "gid": "1219297132", "csv": "cases"})
+        # deaths
+        deaths = executor.submit(fetch_csv, DEATHS_URL, create_deaths_df, params={"t": ms})
+        cases_df, cases_changed = cases.result()
+        deaths_df, deaths_changed = deaths.result()
+    # small key for everything memoized downstream of the data, only
+    # replaced (along with its timestamp) when one of the files actually
+    # changed. a random token rather than a counter, so a flushed or
+    # restarted cache can't hand out a version that's already memoized
+    previous = cache.get("metrics")
+    if cases_changed or deaths_changed or previous is None:
+        version, updated = uuid.uuid4().hex, datetime.now().isoformat()
+        # the reshapes behind the figures are done here, once per
+        # data change, rather than on a callback's request thread
+        aggregates = build_aggregates(deaths_df, cases_df)
+    else:
+        _, _, updated, version, aggregates = previous
+    logging.info("update_metrics %s", version)
+    metrics = (deaths_df, cases_df, updated, version, aggregates)
+    cache.set("metrics", metrics, timeout=0)
+    # after the metrics, so a reader that sees the new version loads the
+    # new tuple. written every refresh, in case the key was evicted on its own
+    cache.set("data_version", (version, updated), timeout=0)
+    cache.delete("fetch_failed")
+    return metrics
+
+
+# the metrics this worker last loaded from the cache, so callbacks only
+# unpickle the frames again when the data version has moved on
+local_metrics = {"metrics": None}
+# only one callback thread per worker fetches while the cache is cold
+metrics_lock = Lock()
+
+
+def get_metrics():
+    try:
+        return read_metrics()
+    except redis.RedisError:
+        # the shared cache can't be reached, treat it like a failed
+        # fetch and serve this worker's last copy rather than a 500
+        logging.warning("cache unavailable", exc_info=True)
+        if local_metrics["metrics"] is None:
+            raise
+        return local_metrics["metrics"]
+
+
+def read_metrics():
+    # callbacks read what the refresh thread last stored, only fetching
+    # on the request thread if the first refresh hasn't finished yet
+    version, _ = cache.get("data_version") or (None, None)
+    metrics = local_metrics["metrics"]
+    if metrics is not None and metrics[3] == version:
+        return metrics
+    metrics = cache.get("metrics")
+    if metrics is None:
+        # remember a failed fetch for a little while so every callback
+        # doesn't hit the sheet again while the upstream is down
+        with metrics_lock:
+            # another thread may have fetched while this one waited
+            metrics = cache.get("metrics")
+            if metrics is None and not cache.get("metrics_failed"):
+                try:
+                    metrics = update_metrics()
+                except requests.RequestException:
+                    logging.warning("update_metrics failed", exc_info=True)
+                    cache.set("metrics_failed", True, timeout=server.config["FAILED_FETCH_TIMEOUT"])
+                    cache.set("fetch_failed", True, timeout=0)
+        if metrics is None:
+            # stale data this worker already had beats an error banner
+            metrics = local_metrics["metrics"]
+        if metrics is None:
+            raise requests.RequestException("no data retrieved yet")
+    local_metrics["metrics"] = metrics
+    return metrics
+
+
+def fetch_failed():
+    # the latest fetch failed, or the cache is down and the
+    # metrics are this worker's last copy
+    try:
+        return cache.get("fetch_failed")
+    except redis.RedisError:
+        return True
+
+
+def refresh_metrics():
+    while True:
+        try:
+            update_metrics()
+        except requests.RequestException:
+            # keep serving the last stored metrics, flagged as stale
+            logging.warning("refresh_metrics failed", exc_info=True)
+            cache.set("fetch_failed", True, timeout=0)
+        except Exception:
+            logging.exception("refresh_metrics failed")
+        time.sleep(server.config["REFRESH_INTERVAL"])
 
 
 # date format is bad / missing year sometimes
 # try to fix these if possible
-def fix_bad_dates(d):
-    date_parts = d.split("/")
+def fix_bad_dates(dates):
     # sometimes multiple /'s so strip these out
-    date_parts = [d for d in date_parts if d != ""]
-    if len(date_parts) == 2:
-        return f"{date_parts[0]}/{date_parts[1]}/2020"
-    return f"{date_parts[0]}/{date_parts[1]}/{date_parts[2]}"
-
-
-def create_age_buckets(x):
-    try:
-        return str(int(x) - (int(x) % 10)) + "s"
-    except ValueError:
-        return 'NA'
+    dates = dates.str.replace('/+', '/', regex=True).str.strip('/')
+    # only the first three parts are month/day/year, drop anything after
+    dates = dates.str.replace('^([^/]*/[^/]*/[^/]*)/.*$', r'\1', regex=True)
+    dates = dates.mask(dates.str.count('/') == 1, dates + '/2020')
+    parsed = pd.to_datetime(dates, format='%m/%d/%Y', errors='coerce', cache=True)
+    # anything not in m/d/Y falls back to the slower format inference
+    bad = parsed.isna() & dates.notna()
+    if bad.any():
+        parsed[bad] = pd.to_datetime(dates[bad])
+    return parsed
+
+
+def create_age_buckets(ages):
+    # 10 year buckets ordered by age, anything that
+    # isn't a number goes in the NA bucket (sorted first)
+    decades = (pd.to_numeric(ages, errors='coerce') // 10).fillna(-1).astype(int).clip(lower=-1)
+    # a header-only csv has no ages, so no max either
+    oldest = int(decades.max()) if len(decades) else -1
+    categories = ['NA'] + [f"{d * 10}s" for d in range(oldest + 1)]
+    buckets = pd.Categorical.from_codes(decades + 1, categories=categories, ordered=True)
+    return pd.Series(buckets, index=ages.index)
+
+
+# the columns the figures use (after format_columns for cases),
+# anything else in the files is skipped while parsing
+CASES_COLUMNS = ("reported_date", "city", "age", "sex")
+DEATHS_COLUMNS = ("city", "age", "gender")
 
 
 def create_deaths_df(deaths):
     bs = io.BytesIO(deaths)
-    deaths_df = pd.read_csv(bs, encoding="utf-8")
-    deaths_df = deaths_df.dropna(axis=0, thresh=2)
+    deaths_df = pd.read_csv(bs, encoding="utf-8", usecols=DEATHS_COLUMNS, dtype=str)
+    # only drop the blank rows, counted over the columns we use so
+    # reading fewer columns can't change which rows are kept
+    deaths_df = deaths_df.dropna(axis=0, how='all', subset=list(DEATHS_COLUMNS))
     deaths_df.city = deaths_df.city.str.title()
-    deaths_df.age = deaths_df.age.apply(create_age_buckets)
+    deaths_df.age = create_age_buckets(deaths_df.age)
     deaths_df = deaths_df.rename(columns={"gender": "sex"})
+    # low cardinality, group and filter on integer codes
+    for col in ('city', 'sex'):
+        deaths_df[col] = deaths_df[col].astype('category')
     return deaths_df
 
 
-def format_column(col):
-    f_col = re.findall('[A-Z][a-z]*', col)
-    f_col = [x.lower() for x in f_col]
-    return "_".join(f_col)
+CAMEL_CASE_RE = re.compile('[A-Z][a-z]*')
+
+
+# the CSV schema rarely changes so this is cached per tuple of column names
+@functools.lru_cache(maxsize=32)
+def format_columns(columns):
+    # CamelCase to snake_case, e.g. ReportedDate -> reported_date
+    return pd.Index(columns).str.findall(CAMEL_CASE_RE).str.join("_").str.lower()
 
 
 def create_cases_df(cases):
     bs = io.BytesIO(cases)
-    cases_df = pd.read_csv(bs, encoding="utf-8")
-    columns = [format_column(x) for x in cases_df.columns]
-    cases_df.columns = columns
-    cases_df = cases_df.dropna(axis=0, thresh=2)
-    cases_df.age = cases_df.age.apply(create_age_buckets)
+    cases_df = pd.read_csv(
+        bs, encoding="utf-8", usecols=lambda c: format_columns((c,))[0] in CASES_COLUMNS, dtype=str)
+    cases_df.columns = format_columns(tuple(cases_df.columns))
+    cases_df = cases_df.dropna(axis=0, how='all', subset=list(CASES_COLUMNS))
+    cases_df.age = create_age_buckets(cases_df.age)
     cases_df.city = cases_df.city.str.title()
     cases_df.sex = cases_df.sex.str.title().str.strip()
     cases_df.sex = cases_df.sex.replace({"Mal": "Male", "Male To Female": "Female"})
-    cases_df.reported_date = cases_df.reported_date.apply(fix_bad_dates)
-    cases_df.reported_date = pd.to_datetime(cases_df.reported_date)
+    cases_df.reported_date = fix_bad_dates(cases_df.reported_date)
+    # low cardinality, group and filter on integer codes
+    for col in ('city', 'sex'):
+        cases_df[col] = cases_df[col].astype('category')
     return cases_df
 
 
-def parse_table(html_table):
-    data = []
-    rows = html_table.find_all('tr')
-    for i, row in enumerate(rows):
-        cells = row.find_all('td')
-        parsed_row = []
-        for j, cell in enumerate(cells):
-            # some malformed tags with inline styles
-            # exclude these.
-            has_style = cell.find('style')
-            # TODO maybe change to below to exclude all non-string tags
-            # "".join([x.strip() for x in cell if isinstance(x, bs4.element.NavigableString)])
-            if has_style:
-                cell.style.extract()
-            parsed_row.append(cell.get_text(strip=True))
-        data.append(parsed_row)
-    return data
-
-
-@app.callback(Output('ticker-text', 'children'),
-              [Input('interval', 'n_intervals')])
-def update_date(n_intervals):
+@app.callback([Output('ticker-text', 'children'), Output('ticker-shown', 'data')],
+              [Input('interval', 'n_intervals')],
+              [State('ticker-shown', 'data')])
+def update_date(n_intervals, shown):
     # call once and chain other dependent calls of this, so not making
-    # api calls on every update
+    # api calls on every update. the text only changes with the data
+    # version, so downstream callbacks keep hitting their cache entries
     try:
-        _, _, now = update_metrics()
-        return [html.P(f"Last update: {now}")]
-    except:
+        _, _, updated, _, _ = get_metrics()
+        text = f"Last update: {updated}"
+        # the latest fetch failed, so this is the last data we did get
+        if fetch_failed():
+            text = f"Last update (cached): {updated}"
+        # most ticks find the same data, leave the page and the
+        # callbacks chained off the ticker alone
+        if text == shown:
+            return dash.no_update, dash.no_update
+        return [html.P(text)], text
+    except (requests.RequestException, redis.RedisError):
+        logging.warning("no data to show", exc_info=True)
         return html.Div(
             className='global-error',
             children=[
                 html.I(className="fa fa-times-circle"),
                 '  There was an issue retrieving the updated data. Please check back shortly.'
             ]
-        )
+        ), None
+    except Exception:
+        logging.exception("update_metrics failed")
+        raise
 
 
 @app.callback(
     Output('demo-dropdown', "options"),
     [Input('ticker-text', "children")])
 def update_dropdown(children):
-    _, cases_df, _ = update_metrics()
-    # TODO would be nice not do this each time probably can cache too
-    df = cases_df.drop_duplicates(subset=['city'])
-    values = [{"label": value, "value": value} for label, value in zip(df['city'], df['city']) if label]
-    return sorted(values, key=lambda k: k['label'])
-
-
-def age_sort_key(a):
-    try:
-        return int(a.replace("s", ""))
-    except ValueError:
-        return -99
+    _, _, _, _, aggregates = get_metrics()
+    return aggregates["city_options"]
+
+
+def build_aggregates(deaths_df, cases_df):
+    by_day = daily_counts(cases_df)
+    return {
+        # astype('category') already gives the unique cities, sorted
+        "city_options": [{"label": c, "value": c} for c in cases_df['city'].cat.categories if c],
+        "by_day": by_day,
+        # (dates, running total) as plain arrays, ready to plot
+        "cumulative_by_day": (by_day.index.to_numpy(), by_day.cumsum().to_numpy()),
+        "by_day_by_city": daily_counts_by_city(cases_df),
+        "cases_by_city": cases_df["city"].value_counts(),
+        "deaths_by_city": deaths_df["city"].value_counts(),
+        # only the buckets present, the age axis adds the missing ones in order
+        "cases_by_age": cases_df["age"].cat.remove_unused_categories().value_counts(sort=False),
+        "deaths_by_age": deaths_df["age"].cat.remove_unused_categories().value_counts(sort=False),
+        "cases_by_sex": cases_df["sex"].value_counts(sort=False),
+        "deaths_by_sex": deaths_df["sex"].value_counts(sort=False),
+        "cases_age_by_city": counts_by_city(cases_df, "age"),
+        "deaths_age_by_city": counts_by_city(deaths_df, "age"),
+        "cases_sex_by_city": counts_by_city(cases_df, "sex"),
+        "deaths_sex_by_city": counts_by_city(deaths_df, "sex"),
+        # the buckets are ordered categories, 20s before 100s
+        "age_labels": list(cases_df.age.cat.remove_unused_categories().cat.categories),
+    }
 
 
 @app.callback(
@@ -263,61 +431,93 @@ def age_sort_key(a):
         Input('ticker-text', "children")
     ]
 )
-@cache.memoize()
 def update_figure(cities, _):
+    _, _, _, version, _ = get_metrics()
+    if not cities:
+        return summary_graphs(version)
+    # the order the cities were picked in doesn't change the figures,
+    # so every selection of the same cities shares one cache entry
+    cities = tuple(sorted(cities))
+    return [
+        dcc.Graph(id=graph_id, figure=figure, className="plot")
+        for graph_id, figure in build_figures(cities, version)
+    ]
+
+
+# the county summary is what every visitor lands on, keep it in
+# process so the common case skips unpickling from the cache
+@functools.lru_cache(maxsize=4)
+def summary_graphs(version):
+    return [
+        dcc.Graph(id=graph_id, figure=figure, className="plot")
+        for graph_id, figure in build_figures((), version)
+    ]
+
+
+# figures are cached as the plain dicts from to_plotly_json,
+# so a cache hit doesn't rebuild or re-validate any go.Figure
+@cache.memoize()
+def build_figures(cities, version):
     figures = []
-    now = datetime.now().isoformat()
-    logging.info("update_figure {0}".format(now))
-    deaths_df, cases_df, _ = update_metrics()
-    if cities is None or len(cities) == 0:
-        fig = cumulative_by_day_scatter(cases_df)
-        figures.append(dcc.Graph(id="by_day_cumulative", figure=fig, className="plot"))
-        fig = by_day_scatter(cases_df)
-        figures.append(dcc.Graph(id="by_day", figure=fig, className="plot"))
-        fig = top(cases_df)
-        figures.append(dcc.Graph(id="top_n", figure=fig, className="plot"))
-        fig = top(deaths_df, layout_overrides={"title": "<b>COVID-19 Deaths by City</b>"})
-        figures.append(dcc.Graph(id="deaths", figure=fig, className="plot"))
-        # 100s, 20s etc sort by numeric value
-        age_labels = sorted(cases_df.age.unique(), key=age_sort_key)
-        fig = histogram(cases_df, "age", layout_overrides={
+    logging.info("update_figure %s", cities)
+    _, _, _, _, aggregates = get_metrics()
+    age_labels = aggregates["age_labels"]
+    # the summary and per-city views reuse graph ids for different charts,
+    # so zoom and legend state survive refreshes but not a new selection
+    revision = {"uirevision": str(cities)}
+    if not cities:
+        fig = cumulative_by_day_scatter(aggregates["cumulative_by_day"], layout_overrides=revision)
+        figures.append(("by_day_cumulative", fig.to_plotly_json()))
+        fig = by_day_scatter(aggregates["by_day"], layout_overrides=revision)
+        figures.append(("by_day", fig.to_plotly_json()))
+        fig = top(aggregates["cases_by_city"], layout_overrides=revision)
+        figures.append(("top_n", fig.to_plotly_json()))
+        fig = top(aggregates["deaths_by_city"], layout_overrides={**revision, "title": "<b>COVID-19 Deaths by City</b>"})
+        figures.append(("deaths", fig.to_plotly_json()))
+        fig = histogram(aggregates["cases_by_age"], layout_overrides={
+            **revision,
             "title": "<b>COVID-19 Cases by Age Range</b>",
             "xaxis": {"categoryarray": age_labels, "categoryorder": "array"}})
-        figures.append(dcc.Graph(id="age", figure=fig, className="plot"))
-        fig = histogram(deaths_df, "age", layout_overrides={
+        figures.append(("age", fig.to_plotly_json()))
+        fig = histogram(aggregates["deaths_by_age"], layout_overrides={
+            **revision,
             "title": "<b>COVID-19 Deaths by Age Range</b>",
             "xaxis": {"categoryarray": age_labels, "categoryorder": "array"}})
-        figures.append(dcc.Graph(id="deaths_age", figure=fig, className="plot"))
-        fig = histogram(cases_df, "sex", layout_overrides={"title": "<b>COVID-19 Cases by Sex</b>"})
-        figures.append(dcc.Graph(id="sex", figure=fig, className="plot"))
-        fig = histogram(deaths_df, "sex", layout_overrides={
+        figures.append(("deaths_age", fig.to_plotly_json()))
+        fig = histogram(aggregates["cases_by_sex"], layout_overrides={**revision, "title": "<b>COVID-19 Cases by Sex</b>"})
+        figures.append(("sex", fig.to_plotly_json()))
+        fig = histogram(aggregates["deaths_by_sex"], layout_overrides={
+            **revision,
             "title": "<b>COVID-19 Deaths by Sex</b>",
             "xaxis": {"categoryarray": ["Female", "Male"], "categoryorder": "array"},
         })
-        figures.append(dcc.Graph(id="deaths_sex", figure=fig, className="plot"))
+        figures.append(("deaths_sex", fig.to_plotly_json()))
         return figures
 
-    dff = cases_df[cases_df["city"].isin(cities)]
-    fig = cumulative_by_city(dff)
-    figures.append(dcc.Graph(id="by_day", figure=fig, className="plot"))
-    fig = by_day_by_city_scatter(dff)
-    figures.append(dcc.Graph(id="by_day_cumulative", figure=fig, className="plot"))
-    age_labels = sorted(cases_df.age.unique(), key=age_sort_key)
-    fig = histogram_by_city(cases_df, "age", cities, layout_overrides={
+    by_day_by_city = daily_by_city_long(select_cities(aggregates["by_day_by_city"], cities))
+    fig = cumulative_by_city(by_day_by_city, layout_overrides=revision)
+    figures.append(("by_day", fig.to_plotly_json()))
+    fig = by_day_by_city_scatter(by_day_by_city, layout_overrides=revision)
+    figures.append(("by_day_cumulative", fig.to_plotly_json()))
+    fig = histogram_by_city(aggregates["cases_age_by_city"], cities, layout_overrides={
+        **revision,
         "title": "<b>COVID-19 Cases by Age Range</b>",
         "xaxis": {"categoryarray": age_labels, "categoryorder": "array"}})
-    figures.append(dcc.Graph(id="deaths_age", figure=fig, className="plot"))
-    fig = histogram_by_city(deaths_df, "age", cities, layout_overrides={
+    figures.append(("deaths_age", fig.to_plotly_json()))
+    fig = histogram_by_city(aggregates["deaths_age_by_city"], cities, layout_overrides={
+        **revision,
         "title": "<b>COVID-19 Deaths by Age Range</b>",
         "xaxis": {"categoryarray": age_labels, "categoryorder": "array"}})
-    figures.append(dcc.Graph(id="age", figure=fig, className="plot"))
-    fig = histogram_by_city(cases_df, "sex", cities, layout_overrides={"title": "<b>COVID-19 Cases by Sex</b>"})
-    figures.append(dcc.Graph(id="deaths_sex", figure=fig, className="plot"))
-    fig = histogram_by_city(deaths_df, "sex", cities, layout_overrides={
+    figures.append(("age", fig.to_plotly_json()))
+    fig = histogram_by_city(aggregates["cases_sex_by_city"], cities,
+                            layout_overrides={**revision, "title": "<b>COVID-19 Cases by Sex</b>"})
+    figures.append(("deaths_sex", fig.to_plotly_json()))
+    fig = histogram_by_city(aggregates["deaths_sex_by_city"], cities, layout_overrides={
+        **revision,
         "title": "<b>COVID-19 Deaths by Sex</b>",
         "xaxis": {"categoryarray": ["Female", "Male"], "categoryorder": "array"},
     })
-    figures.append(dcc.Graph(id="sex", figure=fig, className="plot"))
+    figures.append(("sex", fig.to_plotly_json()))
     return figures
 
 
@@ -338,174 +538,167 @@ DEFAULT_LAYOUT = {
 }
 
 
-def top(df, layout_overrides=None):
-    layout = copy.deepcopy(DEFAULT_LAYOUT)
+def merge_layout(overrides=None):
+    # DEFAULT_LAYOUT with the overrides applied, nested dicts
+    # (xaxis etc.) are merged one level down instead of replaced
+    layout = {k: dict(v) if isinstance(v, dict) else v for k, v in DEFAULT_LAYOUT.items()}
+    for k, v in (overrides or {}).items():
+        if isinstance(v, dict) and isinstance(layout.get(k), dict):
+            layout[k] = {**layout[k], **v}
+        else:
+            layout[k] = v
+    return layout
+
+
+def top(counts, layout_overrides=None):
+    # counted once per refresh, one bar per city rather
+    # than every row for plotly to bin in the browser
+    layout = merge_layout(layout_overrides)
     fig = go.Figure({
         "data": [
             {
-                "x": df["city"],
-                "type": "histogram",
+                "x": counts.index,
+                "y": counts.values,
+                "type": "bar",
             },
         ],
         "layout": layout,
     })
     fig.update_layout(title_text="<b>COVID-19 Cases by City</b>")
     fig.update_xaxes(categoryorder="total descending")
-    if layout_overrides:
-        layout.update(layout_overrides)
     fig.update_layout(layout)
     return fig
 
 
-def by_day_by_city_scatter(df, layout_overrides=None):
-    x = df.groupby(["city", "reported_date"]).size().reset_index(name='counts')
-    x.reported_date = pd.to_datetime(x.reported_date)
-    x = x.set_index(
-        ['reported_date', 'city']
-    ).unstack(
-        fill_value=0
-    ).asfreq(
-        'D', fill_value=0
-    ).stack().sort_index(level=1).reset_index()
-    x = x.sort_values(['city', 'reported_date'])
+def daily_counts(df):
+    # case counts per reported_date,
+    # days without any cases are filled with 0
+    counts = df['reported_date'].dt.normalize().value_counts().sort_index()
+    days = pd.date_range(counts.index.min(), counts.index.max(), freq='D')
+    return counts.reindex(days, fill_value=0)
+
+
+def daily_counts_by_city(df):
+    # reported_date x city matrix of case counts,
+    # days without any cases are filled with 0
+    wide = df.pivot_table(index='reported_date', columns='city', aggfunc='size', fill_value=0, observed=True)
+    days = pd.date_range(wide.index.min(), wide.index.max(), freq='D')
+    return wide.reindex(days, fill_value=0).rename_axis('reported_date')
+
+
+def select_cities(by_day_by_city, cities):
+    # the selected city columns of daily_counts_by_city, trimmed to the
+    # days between the first and last case in any of those cities
+    wide = by_day_by_city.loc[:, by_day_by_city.columns.isin(cities)]
+    days = wide.index[wide.any(axis=1)]
+    return wide.loc[days.min():days.max()]
+
+
+def counts_by_city(df, column):
+    # column value x city matrix of counts
+    return df.pivot_table(index=column, columns='city', aggfunc='size', fill_value=0, observed=True)
+
+
+def daily_by_city_long(by_day_by_city):
+    # one long reported_date/city frame with the daily counts, running
+    # totals and moving averages, shared by both per-city figures
+    x = by_day_by_city.reset_index().melt(
+        id_vars='reported_date', var_name='city', value_name='counts')
+    # one cumsum down the date x city matrix, not one per city group,
+    # melt stacks the columns one after another so ravel in 'F' order
+    x['cumulative_sum'] = by_day_by_city.cumsum().to_numpy().ravel(order='F')
+    # 7-day moving average by city, one rolling over the whole matrix
+    x['ma7'] = by_day_by_city.rolling(7).mean().to_numpy().ravel(order='F')
+    return x
+
+
+def by_day_by_city_scatter(x, layout_overrides=None):
     fig = px.bar(x, x="reported_date", y="counts", color="city", barmode='group')
-    layout = copy.deepcopy(DEFAULT_LAYOUT)
-    # add 7-day moving average by city
-    x['ma7'] = x.groupby('city')['counts'].transform(lambda x: x.rolling(7).mean())
+    layout = merge_layout(layout_overrides)
     fig2 = px.line(x, x="reported_date", y="ma7", color="city", labels={"ma7": "7-day moving average"})
-    for f in fig2.data:
-        f["legendgroup"] = f["legendgroup"] + " 7-day moving average"
-        f["name"] = f["name"] + " 7-day moving average"
-    _ = [fig.add_trace(t) for t in fig2.data]
+    fig2.for_each_trace(lambda t: t.update(
+        legendgroup=t.legendgroup + " 7-day moving average", name=t.name + " 7-day moving average"))
+    # one add_traces call validates the figure once, not once per trace
+    fig.add_traces(tuple(fig2.data))
     fig.update_layout(title_text="<b>Daily COVID-19 Cases</b>")
     fig.update_layout(showlegend=True, legend_title=None, legend_orientation="h")
-    if layout_overrides:
-        layout.update(layout_overrides)
     fig.update_layout(layout)
     return fig
 
 
-def cumulative_by_city(df, layout_overrides=None):
-    by_city_by_day = df.groupby(["city", "reported_date"]).size().reset_index(name='counts')
-    by_city_by_day.reported_date = pd.to_datetime(by_city_by_day.reported_date)
-    by_city_by_day = by_city_by_day.set_index(
-        ['reported_date', 'city']
-    ).unstack(
-        fill_value=0
-    ).asfreq(
-        'D', fill_value=0
-    ).stack().sort_index(level=1).reset_index()
-    by_city_by_day = by_city_by_day.sort_values(['city', 'reported_date'])
-    by_city_by_day["cumulative_sum"] = by_city_by_day.groupby('city')['counts'].cumsum()
-
-    fig = px.scatter(by_city_by_day, x="reported_date", y="cumulative_sum", color="city")
-    layout = copy.deepcopy(DEFAULT_LAYOUT)
+def cumulative_by_city(by_city_by_day, layout_overrides=None):
+    fig = px.scatter(by_city_by_day, x="reported_date", y="cumulative_sum", color="city", render_mode="webgl")
+    layout = merge_layout(layout_overrides)
     fig.update_layout(title_text="<b>Cumulative COVID-19 Cases")
     fig.update_layout(showlegend=True, legend_title=None, legend_orientation="h")
     fig.update_traces(mode='lines+markers')
-    if layout_overrides:
-        layout.update(layout_overrides)
     fig.update_layout(layout)
     return fig
 
 
-def by_day_scatter(df, layout_overrides=None):
-    by_day = df['reported_date'].dt.date.value_counts()
-    by_day.index = pd.to_datetime(by_day.index)
-    by_day = by_day.resample("D").sum().fillna(0)
-    by_day = by_day.sort_index()
+def by_day_scatter(by_day, layout_overrides=None):
     fig = px.bar(x=by_day.index, y=by_day)
-    layout = copy.deepcopy(DEFAULT_LAYOUT)
+    layout = merge_layout(layout_overrides)
     # add 7-day moving average
     ma7 = by_day.rolling(7).mean()
     fig.add_trace(go.Scatter(x=by_day.index, y=ma7, mode='lines', name='7 day moving average'))
     fig.update_layout(title_text="<b>Daily COVID-19 Cases</b>")
     fig.update_layout(legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01))
-    if layout_overrides:
-        layout.update(layout_overrides)
     fig.update_layout(layout)
     return fig
 
 
-def cumulative_by_day_scatter(df, layout_overrides=None):
-    by_day = df.groupby(["reported_date"]).size().reset_index(name='counts')
-    by_day.reported_date = pd.to_datetime(by_day.reported_date)
-    by_day = by_day.set_index(
-        ['reported_date']
-    ).asfreq(
-        'D', fill_value=0
-    ).sort_index(level=1).reset_index()
-    by_day["cumulative_sum"] = by_day['counts'].cumsum()
-
-    fig = go.Figure(data=go.Scatter(x=by_day.reported_date, y=by_day.cumulative_sum, mode='lines+markers'))
+def cumulative_by_day_scatter(cumulative_by_day, layout_overrides=None):
+    dates, cumulative_sum = cumulative_by_day
+    fig = go.Figure(data=go.Scattergl(x=dates, y=cumulative_sum, mode='lines+markers'))
     fig.update_layout(title_text="<b>Cumulative COVID-19 Cases</b>")
-    layout = copy.deepcopy(DEFAULT_LAYOUT)
-    if layout_overrides:
-        layout.update(layout_overrides)
+    layout = merge_layout(layout_overrides)
     fig.update_layout(layout)
     return fig
 
 
-def histogram_by_city(df, column, cities, layout_overrides=None):
-    x = (df.groupby(["city", column])[column]
-         .count()
-         .unstack(fill_value=0)
-         .stack()
-         .sort_index(level=0)
-         .reset_index(name="counts")
-         )
-
-    bars = []
+def histogram_by_city(counts, cities, layout_overrides=None):
+    # counts is the counts_by_city matrix for the column
     categories = None
     try:
         categories = layout_overrides["xaxis"]["categoryarray"]
     except:
         pass
-    for city in cities:
-        bar = x[x.city == city]
-        if categories is not None:
-            cats = pd.DataFrame(categories, columns=[column])
-            cats["counts"] = 0
-            cats["city"] = city
-            missing_cats = cats[~cats[column].isin(bar[column])]
-            bar = pd.concat([missing_cats, bar])
-        bars.append(go.Bar(name=city, x=bar[column], y=bar.counts))
+    index = list(counts.index)
+    if categories is not None:
+        index += [c for c in categories if c not in counts.index]
+    # 0 counts for the missing categories and for cities with no rows
+    counts = counts.reindex(index=index, columns=list(cities), fill_value=0)
+    bars = [go.Bar(name=city, x=counts.index, y=counts[city].values) for city in cities]
 
     fig = go.Figure(data=bars)
     fig.update_layout(barmode='group')
     fig.update_layout(showlegend=True, legend_orientation="h")
     fig.update_xaxes(categoryorder="category ascending")
-    layout = copy.deepcopy(DEFAULT_LAYOUT)
-    if layout_overrides:
-        layout.update(layout_overrides)
+    layout = merge_layout(layout_overrides)
     fig.update_layout(layout)
     return fig
 
 
-def histogram(df, column, layout_overrides=None):
-    x = (df.groupby([column])[column]
-         .count()
-         .reset_index(name="counts")
-         .sort_index(level=0))
+def histogram(counts, layout_overrides=None):
     categories = None
     try:
         categories = layout_overrides["xaxis"]["categoryarray"]
     except:
         pass
     if categories is not None:
-        cats = pd.DataFrame(categories, columns=[column])
-        cats["counts"] = 0
-        missing_cats = cats[~cats[column].isin(x[column])]
-        x = pd.concat([missing_cats, x])
-    fig = go.Figure(data=go.Bar(x=x[column], y=x.counts))
-    layout = copy.deepcopy(DEFAULT_LAYOUT)
+        missing_cats = [c for c in categories if c not in counts.index]
+        counts = pd.concat([pd.Series(0, index=missing_cats, dtype=counts.dtype), counts])
+    fig = go.Figure(data=go.Bar(x=counts.index, y=counts.values))
+    layout = merge_layout(layout_overrides)
     fig.update_xaxes(categoryorder="category ascending")
-    if layout_overrides:
-        layout.update(layout_overrides)
     fig.update_layout(layout)
     return fig
 
 
+Thread(target=refresh_metrics, daemon=True).start()
+
+
 @app.server.route('/robots.txt')
 def robots():
     return send_file('robots.txt', mimetype="text")
@@ -0,0 +1,11 @@
+import settings
+
+workers = settings.WORKERS
+threads = settings.THREADS
+worker_class = "gthread"
+# with a shared redis cache, import the app once in the master before
+# forking the workers, so the refresh thread only runs there and the
+# workers read what it stores. a simple cache is per process, so each
+# worker imports the app and runs its own refresh thread instead.
+# the workers make their own requests session (app.get_session)
+preload_app = settings.CACHE_TYPE == "redis"
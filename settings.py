@@ -8,11 +8,27 @@ DEBUG = env.bool("DEBUG", default=False)
 HOST = env.str("HOST", default="0.0.0.0")
 PORT = env.int("PORT", default=5000)
 
+# gunicorn, see deploy/gunicorn.conf.py
+WORKERS = env.int("WORKERS", default=2)
+THREADS = env.int("THREADS", default=4)
+
 SECONDS = 1000
 MINUTES = 60 * SECONDS
-UPDATE_INTERVAL = 15 * MINUTES  # in milliseconds
+# how often browsers check for new data, cheap when nothing changed
+UPDATE_INTERVAL = 1 * MINUTES  # in milliseconds
+# how often the background thread re-fetches the data
+REFRESH_INTERVAL = 13 * 60  # in seconds
+# how long a failed fetch is remembered before callbacks try again
+FAILED_FETCH_TIMEOUT = 60  # in seconds
 
-# Use filesystem for cache
-CACHE_DIR = env.str("CACHE_DIR", default="/tmp/cache")
-CACHE_TYPE = "filesystem"
+# "simple" keeps the cache in process and needs nothing else running,
+# every gunicorn worker then fetches and refreshes its own copy.
+# "redis" shares it between all gunicorn workers so the data is fetched
+# and parsed once per refresh, not once per worker, docker-compose sets it
+CACHE_TYPE = env.str("CACHE_TYPE", default="simple")
+CACHE_REDIS_URL = env.str("CACHE_REDIS_URL", default="redis://localhost:6379/0")
 CACHE_DEFAULT_TIMEOUT = 13 * 60  # in seconds
+# frames, validators and aggregates are kept in redis across deploys,
+# bump this whenever what's stored changes shape so new code doesn't
+# read entries written by the old one
+CACHE_KEY_PREFIX = "dashboard-v1:"